@@ -1,14 +1,22 @@
 import os
+import math
+import time
+import json
+import gzip
+import hmac
+import hashlib
 import asyncio
 import sqlite3
 import datetime
 import csv
-from flask import Flask
-from threading import Thread
+from flask import Flask, Response, request
+from threading import Thread, Lock
 from telegram import (
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
     ReplyKeyboardMarkup
 )
 from telegram.ext import (
@@ -18,8 +26,11 @@ from telegram.ext import (
     CallbackQueryHandler,
     ContextTypes,
     ConversationHandler,
+    TypeHandler,
+    InlineQueryHandler,
     filters
 )
+from telegram.error import RetryAfter, Forbidden, BadRequest, NetworkError, TelegramError
 
 # ====================================
 # CONFIG
@@ -41,6 +52,81 @@ RANKS = [
     "2LT", "LTA", "CPT", "MAJ", "LTC", "SLTC", "COL"
 ]
 
+RANK_INDEX = {rank: i for i, rank in enumerate(RANKS)}
+
+# (category, lowest rank, highest rank), listed most senior first
+RANK_CATEGORIES = [
+    ("Officers", "2LT", "COL"),
+    ("WOs", "3WO", "SWO"),
+    ("Specialists", "3SG", "MSG"),
+    ("Men", "REC", "CFC"),
+]
+
+CATEGORY_RANKS = {
+    category: [r for r in RANKS if RANK_INDEX[low] <= RANK_INDEX[r] <= RANK_INDEX[high]]
+    for category, low, high in RANK_CATEGORIES
+}
+
+AVAILABILITY_STATES = ["PRESENT", "AM OFF", "PM OFF", "FULL OFF", "LEAVE"]
+
+# Monthly entitlement credited on the 1st: (category, OFFs, LEAVEs). Adjust to unit policy.
+ACCRUAL_RULES = [
+    ("Officers", 0, 2),
+    ("WOs", 0, 2),
+    ("Specialists", 0, 2),
+    ("Men", 0, 1),
+]
+ACCRUAL_TIME = datetime.time(hour=0, minute=5)
+
+# Conversation housekeeping (seconds)
+CONVERSATION_TIMEOUT = 300
+USER_DATA_TTL = 3600
+SWEEP_INTERVAL = 600
+
+# user_data keys set midway through the register / off / leave flows
+FLOW_KEYS = ("rank", "reg_name", "reg_rank", "offs", "off_type", "leave_start")
+
+# Broadcast limits (Telegram allows ~30 msgs/sec across all chats)
+BROADCAST_RATE = 25
+BROADCAST_BATCH = 25
+BROADCAST_MAX_RETRIES = 3
+
+FIND_LIMIT = 20
+
+# Set by init_db(); falls back to LIKE search if this SQLite build has no FTS5
+FTS_AVAILABLE = False
+
+# Rendered "My Status" cards: {user_id: ((date, epoch, version), text)}.
+# Writers bump STATUS_VERSIONS[user_id], or STATUS_EPOCH for roster-wide changes.
+STATUS_VERSIONS = {}
+STATUS_EPOCH = 0
+STATUS_CACHE = {}
+
+# Bumped on every write; anything cached roster-wide keys off this
+DATA_VERSION = 0
+
+# Inline mode: Telegram-side cache (seconds) and our own per-query result cache
+INLINE_CACHE_TIME = 60
+INLINE_CACHE_MAX = 256
+INLINE_CACHE = {}
+INLINE_CACHE_KEY = None
+
+# Who may pull roster-wide data (strength, on leave, name lookups) inline, e.g. section
+# commanders: comma-separated telegram ids in INLINE_ROSTER_IDS. Admins always can.
+INLINE_ROSTER_IDS = {
+    int(user_id) for user_id in os.environ.get("INLINE_ROSTER_IDS", "").split(",") if user_id.strip()
+}
+
+# Reporting API: requests must send "Authorization: Bearer <API_TOKEN>"; unset disables it
+API_TOKEN = os.environ.get("API_TOKEN")
+API_CACHE_MAX = 256
+API_CACHE = {}
+API_CACHE_KEY = None
+API_CACHE_LOCK = Lock() # Flask serves requests on multiple threads
+
+# DATA_VERSION restarts at 0 with the process, so ETags also carry a per-boot id
+BOOT_ID = str(time.time_ns())
+
 # ====================================
 # DATABASE
 # ====================================
@@ -72,6 +158,13 @@ def init_db():
         c.execute("ALTER TABLE users ADD COLUMN off_counter REAL DEFAULT 0")
     except sqlite3.OperationalError:
         pass # Column already exists
+    
+    # Opening balances (set at registration) and credits since, used by /reconcile
+    for column in ("off_opening REAL", "leave_opening INTEGER", "off_accrued REAL DEFAULT 0", "leave_accrued INTEGER DEFAULT 0"):
+        try:
+            c.execute(f"ALTER TABLE users ADD COLUMN {column}")
+        except sqlite3.OperationalError:
+            pass # Column already exists
 
     # status table
     c.execute("""
@@ -100,10 +193,92 @@ def init_db():
         created_at TEXT
     )
     """)
+    
+    # Add leave_days if missing, and backfill it for old rows
+    try:
+        c.execute("ALTER TABLE leaves ADD COLUMN leave_days INTEGER")
+    except sqlite3.OperationalError:
+        pass
+    c.execute("SELECT id, start_date, end_date FROM leaves WHERE leave_days IS NULL")
+    c.executemany("UPDATE leaves SET leave_days=? WHERE id=?", [
+        (count_leave_days(
+            datetime.datetime.strptime(start, "%Y-%m-%d").date(),
+            datetime.datetime.strptime(end, "%Y-%m-%d").date()
+        ), leave_id)
+        for leave_id, start, end in c.fetchall()
+    ])
+    
+    # offs table, one row per OFF taken (status only keeps the latest)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS offs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        telegram_id INTEGER,
+        off_date TEXT,
+        off_type TEXT,
+        amount REAL,
+        created_at TEXT
+    )
+    """)
+    
+    # accruals table, one row per credited month so a restart never pays twice
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS accruals (
+        period TEXT PRIMARY KEY,
+        applied_at TEXT
+    )
+    """)
+    
+    # Existing users start reconciled: opening = current balance + what they've used
+    c.execute("""
+        UPDATE users SET leave_opening = leave_counter + COALESCE(
+            (SELECT SUM(leave_days) FROM leaves l
+             WHERE l.telegram_id = users.telegram_id AND l.created_at >= users.registered_at), 0)
+        WHERE leave_opening IS NULL
+    """)
+    c.execute("""
+        UPDATE users SET off_opening = off_counter + COALESCE(
+            (SELECT SUM(amount) FROM offs o
+             WHERE o.telegram_id = users.telegram_id AND o.created_at >= users.registered_at), 0)
+        WHERE off_opening IS NULL
+    """)
+    
+    # Indexes for per-user history lookups in the status card
+    c.execute("CREATE INDEX IF NOT EXISTS idx_leaves_user_end ON leaves (telegram_id, end_date)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_offs_user_date ON offs (telegram_id, off_date)")
+    
+    # Full-text index on rank/name for /find, rowid = telegram_id
+    global FTS_AVAILABLE
+    try:
+        c.execute("CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(user_rank, name)")
+        c.execute("""
+            INSERT INTO users_fts (rowid, user_rank, name)
+            SELECT telegram_id, rank, name FROM users
+            WHERE telegram_id NOT IN (SELECT rowid FROM users_fts)
+        """)
+        FTS_AVAILABLE = True
+    except sqlite3.OperationalError:
+        print("FTS5 not available, /find will use a slower LIKE search")
+        FTS_AVAILABLE = False
 
     conn.commit()
     conn.close()
 
+def bump_status_version(user_id=None):
+    # Invalidate cached status cards for one user, or everyone if user_id is None
+    global STATUS_EPOCH, DATA_VERSION
+    DATA_VERSION += 1
+    if user_id is None:
+        STATUS_EPOCH += 1
+    else:
+        STATUS_VERSIONS[user_id] = STATUS_VERSIONS.get(user_id, 0) + 1
+
+def index_users(c, rows):
+    # Keep users_fts in sync. rows: list of (telegram_id, rank, name)
+    if not FTS_AVAILABLE:
+        return
+    c.executemany("DELETE FROM users_fts WHERE rowid=?", [(row[0],) for row in rows])
+    c.executemany("INSERT INTO users_fts (rowid, user_rank, name) VALUES (?, ?, ?)", rows)
+
 def get_user(user_id):
     conn = sqlite3.connect(DB_NAME)
     c = conn.cursor()
@@ -117,11 +292,13 @@ def save_user(user_id, rank, name, off_counter=0.0, leave_counter=0):
     c = conn.cursor()
     c.execute("""
         INSERT OR REPLACE INTO users
-        (telegram_id, rank, name, registered_at, off_counter, leave_counter)
-        VALUES (?, ?, ?, ?, ?, ?)
-    """, (user_id, rank, name, datetime.datetime.now().isoformat(), off_counter, leave_counter))
+        (telegram_id, rank, name, registered_at, off_counter, leave_counter, off_opening, leave_opening)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, (user_id, rank, name, datetime.datetime.now().isoformat(), off_counter, leave_counter, off_counter, leave_counter))
+    index_users(c, [(user_id, rank, name)])
     conn.commit()
     conn.close()
+    bump_status_version(user_id)
 
 def set_status(user_id, state, start_date=None, end_date=None, off_type=None):
     conn = sqlite3.connect(DB_NAME)
@@ -139,6 +316,7 @@ def set_status(user_id, state, start_date=None, end_date=None, off_type=None):
     ))
     conn.commit()
     conn.close()
+    bump_status_version(user_id)
 
 
 def get_all_users():
@@ -157,22 +335,358 @@ def add_leave(user_id, start_date, end_date, leave_days):
     conn = sqlite3.connect(DB_NAME)
     c = conn.cursor()
     c.execute("""
-        INSERT INTO leaves (telegram_id, start_date, end_date, created_at)
-        VALUES (?, ?, ?, ?)
-    """, (user_id, start_date, end_date, datetime.datetime.now().isoformat()))
+        INSERT INTO leaves (telegram_id, start_date, end_date, created_at, leave_days)
+        VALUES (?, ?, ?, ?, ?)
+    """, (user_id, start_date, end_date, datetime.datetime.now().isoformat(), leave_days))
     conn.commit()
     
     # Deduct leave days from user's leave_counter
     c.execute("UPDATE users SET leave_counter = leave_counter - ? WHERE telegram_id=?", (leave_days, user_id))
     conn.commit()
     conn.close()
+    bump_status_version(user_id)
 
 def increment_off(user_id, amount):
     conn = sqlite3.connect(DB_NAME)
     c = conn.cursor()
-    c.execute("UPDATE users SET off_counter = off_counter + ? WHERE telegram_id=?", (amount, user_id))
+    c.execute(
+        "UPDATE users SET off_counter = off_counter + ?, off_accrued = off_accrued + ? WHERE telegram_id=?",
+        (amount, amount, user_id)
+    )
+    conn.commit()
+    conn.close()
+    bump_status_version(user_id)
+
+def deduct_off(user_id, date_text, off_type, amount):
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    c.execute("UPDATE users SET off_counter = off_counter - ? WHERE telegram_id=?", (amount, user_id))
+    c.execute("""
+        INSERT INTO offs (telegram_id, off_date, off_type, amount, created_at)
+        VALUES (?, ?, ?, ?, ?)
+    """, (user_id, date_text, off_type, amount, datetime.datetime.now().isoformat()))
+    conn.commit()
+    conn.close()
+    bump_status_version(user_id)
+
+def get_all_user_ids():
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    c.execute("SELECT telegram_id FROM users")
+    rows = [row[0] for row in c.fetchall()]
+    conn.close()
+    return rows
+
+def rank_category_sql():
+    # CASE expression mapping users.rank to its RANK_CATEGORIES name, built from RANK_INDEX
+    whens = []
+    for category, _, _ in RANK_CATEGORIES:
+        quoted = ", ".join(f"'{r}'" for r in CATEGORY_RANKS[category])
+        whens.append(f"WHEN u.rank IN ({quoted}) THEN '{category}'")
+    return "CASE " + " ".join(whens) + " ELSE 'Others' END"
+
+RANK_CATEGORY_SQL = rank_category_sql()
+
+def find_users(text, limit=FIND_LIMIT):
+    """
+    Prefix search on rank and name, e.g. "cpl ta" matches CPL TAN.
+    Returns rows of (telegram_id, rank, name, off_counter, leave_counter).
+    """
+    
+    terms = text.upper().split()
+    if not terms:
+        return []
+    
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    if FTS_AVAILABLE:
+        match = " ".join('"' + term.replace('"', '""') + '"*' for term in terms)
+        c.execute("""
+            SELECT u.telegram_id, u.rank, u.name, u.off_counter, u.leave_counter
+            FROM users_fts
+            JOIN users u ON u.telegram_id = users_fts.rowid
+            WHERE users_fts MATCH ?
+            ORDER BY users_fts.rank
+            LIMIT ?
+        """, (match, limit))
+    else:
+        where = " AND ".join("(u.rank || ' ' || u.name) LIKE ?" for _ in terms)
+        c.execute(f"""
+            SELECT u.telegram_id, u.rank, u.name, u.off_counter, u.leave_counter
+            FROM users u
+            WHERE {where}
+            LIMIT ?
+        """, [f"%{term}%" for term in terms] + [limit])
+    rows = c.fetchall()
+    conn.close()
+    return rows
+
+def apply_accruals(period):
+    """
+    Credit ACCRUAL_RULES to the whole roster for period (YYYY-MM), one UPDATE per rule.
+    Returns False if the period was already credited.
+    """
+    
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    try:
+        c.execute(
+            "INSERT INTO accruals (period, applied_at) VALUES (?, ?)",
+            (period, datetime.datetime.now().isoformat())
+        )
+    except sqlite3.IntegrityError:
+        conn.close()
+        return False
+    
+    for category, off_amount, leave_amount in ACCRUAL_RULES:
+        ranks = CATEGORY_RANKS[category]
+        placeholders = ", ".join("?" for _ in ranks)
+        c.execute(f"""
+            UPDATE users SET
+                off_counter = off_counter + ?,
+                off_accrued = off_accrued + ?,
+                leave_counter = leave_counter + ?,
+                leave_accrued = leave_accrued + ?
+            WHERE rank IN ({placeholders})
+        """, [off_amount, off_amount, leave_amount, leave_amount] + ranks)
+    
+    conn.commit()
+    conn.close()
+    bump_status_version()
+    return True
+
+def get_balance_drift():
+    """
+    Recompute every balance as opening + credits - usage since registration, in one
+    aggregate query. Returns rows of (rank, name, off_counter, expected_off,
+    leave_counter, expected_leave) for users whose stored balance doesn't match.
+    """
+    
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    c.execute("""
+        SELECT rank, name, off_counter, expected_off, leave_counter, expected_leave
+        FROM (
+            SELECT
+                u.rank, u.name, u.off_counter, u.leave_counter,
+                COALESCE(u.off_opening, 0) + COALESCE(u.off_accrued, 0) - COALESCE(o.used, 0) AS expected_off,
+                COALESCE(u.leave_opening, 0) + COALESCE(u.leave_accrued, 0) - COALESCE(l.used, 0) AS expected_leave
+            FROM users u
+            LEFT JOIN (
+                SELECT o.telegram_id, SUM(o.amount) AS used
+                FROM offs o JOIN users r ON r.telegram_id = o.telegram_id
+                WHERE o.created_at >= r.registered_at
+                GROUP BY o.telegram_id
+            ) o ON o.telegram_id = u.telegram_id
+            LEFT JOIN (
+                SELECT l.telegram_id, SUM(l.leave_days) AS used
+                FROM leaves l JOIN users r ON r.telegram_id = l.telegram_id
+                WHERE l.created_at >= r.registered_at
+                GROUP BY l.telegram_id
+            ) l ON l.telegram_id = u.telegram_id
+        )
+        WHERE ABS(off_counter - expected_off) > 0.001 OR leave_counter != expected_leave
+    """)
+    rows = c.fetchall()
+    conn.close()
+    return rows
+
+def get_balances():
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    c.execute("SELECT telegram_id, rank, name, off_counter, leave_counter FROM users ORDER BY rank, name")
+    rows = c.fetchall()
+    conn.close()
+    return rows
+
+def get_absences(start_date, end_date):
+    """
+    All LEAVEs and OFFs overlapping start_date..end_date (YYYY-MM-DD strings).
+    Returns rows of (telegram_id, rank, name, kind, start_date, end_date, off_type).
+    """
+    
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    c.execute("""
+        SELECT u.telegram_id, u.rank, u.name, a.kind, a.start_date, a.end_date, a.off_type
+        FROM (
+            SELECT telegram_id, 'LEAVE' AS kind, start_date, end_date, NULL AS off_type
+            FROM leaves WHERE start_date <= :end AND end_date >= :start
+            UNION
+            SELECT telegram_id, 'OFF', off_date, off_date, off_type
+            FROM offs WHERE off_date BETWEEN :start AND :end
+            UNION
+            SELECT telegram_id, 'OFF', start_date, end_date, off_type
+            FROM status WHERE state = 'OFF' AND start_date <= :end AND end_date >= :start
+        ) a
+        JOIN users u ON u.telegram_id = a.telegram_id
+        ORDER BY a.start_date, u.rank, u.name
+    """, {"start": start_date, "end": end_date})
+    rows = c.fetchall()
+    conn.close()
+    return rows
+
+def get_on_leave(date_text):
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    c.execute("""
+        SELECT DISTINCT u.rank, u.name, l.start_date, l.end_date
+        FROM leaves l
+        JOIN users u ON u.telegram_id = l.telegram_id
+        WHERE l.start_date <= ? AND l.end_date >= ?
+        ORDER BY l.end_date
+    """, (date_text, date_text))
+    rows = c.fetchall()
+    conn.close()
+    return rows
+
+def get_strength_summary(date_text):
+    """
+    Headcount per (rank category, availability) on date_text, in one GROUP BY query.
+    LEAVE comes from leaves and OFF from offs, falling back to the status row for
+    OFFs taken before the offs log existed. Returns {(category, state): count}.
+    """
+    
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    c.execute(f"""
+        SELECT category, availability, COUNT(*)
+        FROM (
+            SELECT
+                category,
+                CASE
+                    WHEN on_leave THEN 'LEAVE'
+                    WHEN off_type = 'AM' THEN 'AM OFF'
+                    WHEN off_type = 'PM' THEN 'PM OFF'
+                    WHEN off_type IS NOT NULL THEN 'FULL OFF'
+                    ELSE 'PRESENT'
+                END AS availability
+            FROM (
+                SELECT
+                    {RANK_CATEGORY_SQL} AS category,
+                    EXISTS (
+                        SELECT 1 FROM leaves l
+                        WHERE l.telegram_id = u.telegram_id
+                        AND l.start_date <= :day AND l.end_date >= :day
+                    ) AS on_leave,
+                    COALESCE(
+                        (SELECT COALESCE(o.off_type, 'FULL') FROM offs o
+                         WHERE o.telegram_id = u.telegram_id AND o.off_date = :day
+                         ORDER BY o.id DESC LIMIT 1),
+                        (SELECT COALESCE(s.off_type, 'FULL') FROM status s
+                         WHERE s.telegram_id = u.telegram_id AND s.state = 'OFF'
+                         AND s.start_date <= :day AND s.end_date >= :day)
+                    ) AS off_type
+                FROM users u
+            )
+        )
+        GROUP BY category, availability
+    """, {"day": date_text})
+    rows = c.fetchall()
+    conn.close()
+    return {(category, state): count for category, state, count in rows}
+
+def bulk_save_users(rows):
+    """
+    rows: list of (telegram_id, rank, name, off_counter, leave_counter).
+    Inserts/replaces all users and gives new ones a PRESENT status in one transaction.
+    """
+    
+    now = datetime.datetime.now().isoformat()
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    c.executemany("""
+        INSERT OR REPLACE INTO users
+        (telegram_id, rank, name, registered_at, off_counter, leave_counter, off_opening, leave_opening)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, [(tid, rank, name, now, offs, leaves, offs, leaves) for tid, rank, name, offs, leaves in rows])
+    c.executemany("""
+        INSERT OR IGNORE INTO status (telegram_id, state, start_date, end_date, updated_at, off_type)
+        VALUES (?, 'PRESENT', NULL, NULL, ?, NULL)
+    """, [(row[0], now) for row in rows])
+    index_users(c, [(tid, rank, name) for tid, rank, name, _, _ in rows])
+    conn.commit()
+    conn.close()
+    bump_status_version()
+
+def get_absence_conflicts(start_date, end_date):
+    """
+    One query over the whole roster: balances plus whether each user already has
+    a LEAVE or OFF overlapping start_date..end_date (YYYY-MM-DD strings).
+    Returns {telegram_id: (off_counter, leave_counter, leave_clash, off_clash)}.
+    """
+    
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    c.execute("""
+        SELECT u.telegram_id, u.off_counter, u.leave_counter,
+            EXISTS (
+                SELECT 1 FROM leaves l
+                WHERE l.telegram_id = u.telegram_id
+                AND l.start_date <= :end AND l.end_date >= :start
+            ),
+            EXISTS (
+                SELECT 1 FROM offs o
+                WHERE o.telegram_id = u.telegram_id
+                AND o.off_date BETWEEN :start AND :end
+            ) OR EXISTS (
+                SELECT 1 FROM status s
+                WHERE s.telegram_id = u.telegram_id AND s.state = 'OFF'
+                AND s.start_date <= :end AND s.end_date >= :start
+            )
+        FROM users u
+    """, {"start": start_date, "end": end_date})
+    rows = c.fetchall()
+    conn.close()
+    return {row[0]: row[1:] for row in rows}
+
+def bulk_apply_off(user_ids, date_text, off_type, off_amount):
+    now = datetime.datetime.now().isoformat()
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    c.executemany(
+        "UPDATE users SET off_counter = off_counter - ? WHERE telegram_id=?",
+        [(off_amount, user_id) for user_id in user_ids]
+    )
+    c.executemany(
+        "INSERT INTO offs (telegram_id, off_date, off_type, amount, created_at) VALUES (?, ?, ?, ?, ?)",
+        [(user_id, date_text, off_type, off_amount, now) for user_id in user_ids]
+    )
+    c.executemany(
+        "INSERT OR REPLACE INTO status VALUES (?, 'OFF', ?, ?, ?, ?)",
+        [(user_id, date_text, date_text, now, off_type) for user_id in user_ids]
+    )
+    conn.commit()
+    conn.close()
+    bump_status_version()
+
+def bulk_apply_leave(user_ids, start_date, end_date, leave_days):
+    now = datetime.datetime.now().isoformat()
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    c.executemany(
+        "INSERT INTO leaves (telegram_id, start_date, end_date, created_at, leave_days) VALUES (?, ?, ?, ?, ?)",
+        [(user_id, start_date, end_date, now, leave_days) for user_id in user_ids]
+    )
+    c.executemany(
+        "UPDATE users SET leave_counter = leave_counter - ? WHERE telegram_id=?",
+        [(leave_days, user_id) for user_id in user_ids]
+    )
+    c.executemany(
+        "INSERT OR REPLACE INTO status VALUES (?, 'LEAVE', ?, ?, ?, NULL)",
+        [(user_id, start_date, end_date, now) for user_id in user_ids]
+    )
     conn.commit()
     conn.close()
+    bump_status_version()
+
+def get_leaves_starting(date_text):
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    c.execute("SELECT telegram_id, start_date, end_date FROM leaves WHERE start_date=?", (date_text,))
+    rows = c.fetchall()
+    conn.close()
+    return rows
     
 # =====================================   
 # HELPER FUNCTIONS
@@ -207,6 +721,123 @@ def get_today_status_display(user_id):
                     return "🔵 LEAVE"
     return "🟢 PRESENT"
 
+def count_leave_days(start_date: datetime.date, end_date: datetime.date) -> int:
+    # Count weekdays only
+    return sum(
+        1
+        for i in range((end_date - start_date).days + 1)
+        if (start_date + datetime.timedelta(days=i)).weekday() < 5
+    )
+
+def get_status_card(user_id):
+    # Cached per (date, version); repeat taps cost no DB work until a writer bumps the version
+    today = datetime.date.today()
+    key = (today, STATUS_EPOCH, STATUS_VERSIONS.get(user_id, 0))
+    
+    cached = STATUS_CACHE.get(user_id)
+    if cached and cached[0] == key:
+        return cached[1]
+    
+    text = render_status_card(user_id, today)
+    STATUS_CACHE[user_id] = (key, text)
+    return text
+
+def render_status_card(user_id, today: datetime.date):
+    today_text = today.strftime("%Y-%m-%d")
+    
+    conn = sqlite3.connect(DB_NAME)
+    c = conn.cursor()
+    
+    # Counters and current status
+    c.execute("""
+        SELECT u.off_counter, u.leave_counter, s.state, s.start_date, s.end_date
+        FROM users u
+        LEFT JOIN status s ON u.telegram_id = s.telegram_id
+        WHERE u.telegram_id=?
+    """, (user_id,))
+    row = c.fetchone()
+    
+    # Current/future OFFs (status only holds the latest, offs holds the rest)
+    c.execute("""
+        SELECT off_date, off_date, off_type FROM offs
+        WHERE telegram_id=? AND off_date >= ?
+        UNION
+        SELECT start_date, end_date, off_type FROM status
+        WHERE telegram_id=? AND state='OFF' AND end_date >= ?
+        ORDER BY 1
+    """, (user_id, today_text, user_id, today_text))
+    offs_taken = c.fetchall()
+    
+    # Current/future LEAVEs
+    c.execute("""
+        SELECT start_date, end_date FROM leaves
+        WHERE telegram_id=? AND end_date >= ?
+        ORDER BY start_date
+    """, (user_id, today_text))
+    leaves_taken = c.fetchall()
+    conn.close()
+    
+    off_counter = row[0] if row else 0
+    leave_counter = row[1] if row else 0
+    
+    # Default status text
+    if row and row[2]:
+        state, start_date, end_date = row[2:]
+    else:
+        state, start_date, end_date = "PRESENT", None, None
+    status_text = state
+    
+    # --- OFFs taken ---
+    off_text = ""
+    for off_start, off_end, off_type_db in offs_taken:
+        off_dt_start = datetime.datetime.strptime(off_start, "%Y-%m-%d").date()
+        off_dt_end = datetime.datetime.strptime(off_end, "%Y-%m-%d").date()
+        if off_type_db == "AM":
+            off_type_display = "(AM OFF)"
+        elif off_type_db == "PM":
+            off_type_display = "(PM OFF)"
+        else:
+            off_type_display = "(FULL DAY)"
+            
+        if off_dt_start == off_dt_end:
+            off_text += f"\n🟡 Off Taken: {off_dt_start.strftime('%d %b')} {off_type_display}"
+        else:
+            off_text += f"\n🟡 Off Taken: {off_dt_start.strftime('%d %b')} - {off_dt_end.strftime('%d %b')} {off_type_display}"
+    
+    # --- LEAVEs taken ---
+    leave_text = ""
+    for leave_start, leave_end in leaves_taken:
+        leave_dt_start = datetime.datetime.strptime(leave_start, "%Y-%m-%d").date()
+        leave_dt_end = datetime.datetime.strptime(leave_end, "%Y-%m-%d").date()
+        if leave_dt_start == leave_dt_end:
+            leave_text += f"\n🔵 Leave Taken: {leave_dt_start.strftime('%d %b')}"
+        else:
+            leave_text += f"\n🔵 Leaves Taken: {leave_dt_start.strftime('%d %b')} - {leave_dt_end.strftime('%d %b')}"
+    
+    # Daily summary
+    daily_summary = ""
+    if state == "OFF" and start_date and end_date:
+        if start_date <= today_text <= end_date:
+            daily_summary = "🟡 You are OFF today."
+    elif state == "LEAVE" and start_date and end_date:
+        if start_date <= today_text <= end_date and today.weekday() < 5: # Weekdays only
+            daily_summary = "🔵 You are on LEAVE today."
+    
+    # Full status message
+    text = (
+        f"📌 Status: {status_text}\n"
+        f"🟡 Remaining OFFs: {off_counter}\n"
+        f"🔵 Remaining LEAVEs: {leave_counter}"
+    )
+    if off_text:
+        text += f"{off_text}"
+    if leave_text:
+        text += f"{leave_text}"
+    if daily_summary:
+        text += f"\n{daily_summary}"
+    
+    return text
+
 # ====================================
 # DATE CONFLICT CHECKER
 # ====================================
@@ -231,8 +862,17 @@ def check_date_conflict(user_id, new_start: datetime.date, new_end: datetime.dat
             conn.close()
             return f"❌ Conflict with LEAVE from {leave_start} to {leave_end}."
     
-    # Check existing offs
-    c.execute("SELECT start_date, end_date FROM status WHERE telegram_id=? AND state='OFF'", (user_id,))
+    # Check existing offs (offs log, plus the status row for OFFs logged before it existed)
+    c.execute("""
+        SELECT off_date, off_date FROM offs
+        WHERE telegram_id=? AND off_date BETWEEN ? AND ?
+        UNION
+        SELECT start_date, end_date FROM status
+        WHERE telegram_id=? AND state='OFF' AND start_date <= ? AND end_date >= ?
+    """, (
+        user_id, new_start.strftime("%Y-%m-%d"), new_end.strftime("%Y-%m-%d"),
+        user_id, new_end.strftime("%Y-%m-%d"), new_start.strftime("%Y-%m-%d")
+    ))
     offs = c.fetchall()
     for off_start, off_end in offs:
         off_start_dt = datetime.datetime.strptime(off_start, "%Y-%m-%d").date()
@@ -265,7 +905,7 @@ def admin_menu():
         [
             ["🟢 Present", "🟡 Off", "🔵 Leave"],
             ["📌 My Status", "❓ Help"],
-            ["📋 Parade State", "📊 Strength"],
+            ["📋 Parade State", "📊 Strength", "📈 Summary"],
             ["🔄 Reset Parade", "📤 Export CSV"]
         ],
         resize_keyboard=True
@@ -282,6 +922,53 @@ def is_admin(user_id):
     return user_id in ADMIN_IDS
 
 
+# ====================================
+# CONVERSATION HOUSEKEEPING
+# ====================================
+
+def clear_flow_data(user_data):
+    for key in FLOW_KEYS:
+        user_data.pop(key, None)
+
+async def touch_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Runs before every other handler so the sweeper knows who is still active
+    if context.user_data is not None:
+        context.user_data["last_seen"] = time.time()
+
+async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    clear_flow_data(context.user_data)
+    
+    if get_user(user_id):
+        menu = admin_menu() if is_admin(user_id) else user_menu()
+        await update.message.reply_text("❌ Cancelled.", reply_markup=menu)
+    else:
+        await update.message.reply_text("❌ Cancelled. Use /start to register.")
+    return ConversationHandler.END
+
+async def conversation_timeout(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    clear_flow_data(context.user_data)
+    if update.effective_message:
+        await update.effective_message.reply_text("⌛ Timed out. Please start again.")
+
+async def sweep_user_data(context: ContextTypes.DEFAULT_TYPE):
+    # Drop user_data for anyone idle longer than USER_DATA_TTL.
+    # Conversation entries are already dropped by CONVERSATION_TIMEOUT.
+    now = time.time()
+    application = context.application
+    
+    stale = [
+        user_id
+        for user_id, data in application.user_data.items()
+        if now - data.get("last_seen", 0) > USER_DATA_TTL
+    ]
+    for user_id in stale:
+        application.drop_user_data(user_id)
+    
+    if stale:
+        print(f"Swept user_data for {len(stale)} idle users")
+
+
 # ====================================
 # REGISTRATION
 # ====================================
@@ -291,6 +978,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if get_user(user_id):
         menu = admin_menu() if is_admin(user_id) else user_menu()
         await update.message.reply_text("Welcome back! 👇", reply_markup=menu)
+        clear_flow_data(context.user_data)
         return ConversationHandler.END
 
     await update.message.reply_text(
@@ -360,6 +1048,7 @@ async def get_leaves(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"✅ Registration complete!\n{rank} {name}\nStatus: PRESENT\nOFFs: {offs}, LEAVEs: {leaves}",
         reply_markup=menu
     )
+    clear_flow_data(context.user_data)
     return ConversationHandler.END
 
 # ====================================
@@ -417,13 +1106,14 @@ async def off_date_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     c = conn.cursor()
     c.execute("SELECT off_counter FROM users WHERE telegram_id=?", (user_id,))
     row = c.fetchone()
+    conn.close()
     remaining_off = row[0] if row else 0
     
     if off_amount > remaining_off:
-        conn.close()
         await update.message.reply_text(
             f"❌ You only have {remaining_off} OFF remaining."
         )
+        clear_flow_data(context.user_data)
         return ConversationHandler.END
         
     # Check conflicts using helper
@@ -433,12 +1123,7 @@ async def off_date_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ASK_OFF_DATE
         
     # Deduct OFF
-    c.execute(
-        "UPDATE users SET off_counter = off_counter - ? WHERE telegram_id=?",
-        (off_amount, user_id)
-    )
-    conn.commit()
-    conn.close()
+    deduct_off(user_id, date_text, off_type, off_amount)
     
     # Update status
     set_status(user_id, "OFF", date_text, date_text, off_type=off_type)
@@ -459,7 +1144,7 @@ async def off_date_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=menu
     )
     
-    context.user_data.pop("off_type", None)
+    clear_flow_data(context.user_data)
     
     return ConversationHandler.END
     
@@ -476,6 +1161,7 @@ async def start_leave(update: Update, context: ContextTypes.DEFAULT_TYPE):
     conn.close()
     if leaves <= 0:
         await update.message.reply_text("❌ You have no remaining leaves.")
+        clear_flow_data(context.user_data)
         return ConversationHandler.END
     
     await update.message.reply_text("Enter start date of leave (YYYY-MM-DD):")
@@ -507,6 +1193,7 @@ async def leave_end(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if not start:
         await update.message.reply_text("Something went wrong. Please press 🔵 Leave again.")
+        clear_flow_data(context.user_data)
         return ConversationHandler.END
         
     try:
@@ -531,12 +1218,7 @@ async def leave_end(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(conflict_msg + " Please choose different leave dates.")
         return LEAVE_START
     
-    # Count weekdays only
-    leave_days = sum(
-        1
-        for i in range((end_date - start_date).days + 1)
-        if (start_date + datetime.timedelta(days=i)).weekday() < 5
-    )
+    leave_days = count_leave_days(start_date, end_date)
     
     # Check if user has enough leaves
     conn = sqlite3.connect(DB_NAME)
@@ -547,6 +1229,7 @@ async def leave_end(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if leave_days > remaining_leaves:
         await update.message.reply_text(f"❌ You only have {remaining_leaves} LEAVEs remaining. Cannot apply {leave_days} days.")
+        clear_flow_data(context.user_data)
         return ConversationHandler.END
         
     # Save leave record and update status
@@ -556,7 +1239,7 @@ async def leave_end(update: Update, context: ContextTypes.DEFAULT_TYPE):
     menu = admin_menu() if is_admin(user_id) else user_menu()
     await update.message.reply_text(f"🔵 Leave applied: {start} to {end} ({leave_days} days)", reply_markup=menu)
     
-    context.user_data.pop("leave_start", None)
+    clear_flow_data(context.user_data)
     return ConversationHandler.END 
 
 # ====================================
@@ -591,6 +1274,9 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif is_admin(user_id) and text == "📊 Strength":
         await strength(update, context)
 
+    elif is_admin(user_id) and text == "📈 Summary":
+        await strength_summary(update, context)
+
     elif is_admin(user_id) and text == "🔄 Reset Parade":
         await reset_db(update, context)
 
@@ -606,104 +1292,14 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
-        "Use buttons to mark Present, Off, or Leave.\nAdmins have extra commands."
+        "Use buttons to mark Present, Off, or Leave.\n"
+        "Send /cancel to stop any step halfway.\n"
+        "Admins have extra commands."
     )
 
 async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    today = datetime.date.today()
-    
-    # Open DB
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    
-    # Get current status
-    c.execute("SELECT state, start_date, end_date FROM status WHERE telegram_id=?", (user_id,))
-    status_row = c.fetchone()
-    
-    # Get OFFs and LEAVEs
-    c.execute("SELECT off_counter, leave_counter FROM users WHERE telegram_id=?", (user_id,))
-    counters = c.fetchone()
-    conn.close()
-    
-    off_counter = counters[0] if counters else 0
-    leave_counter = counters[1] if counters else 0
-    
-    # Default status text
-    if status_row:
-        state, start_date, end_date = status_row
-        status_text = state
-    else:
-        state, start_date, end_date = "PRESENT", None, None
-        status_text = "PRESENT"
-        
-    # --- OFFs taken ---
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("SELECT start_date, end_date, off_type FROM status WHERE telegram_id=? AND state='OFF'", (user_id,))
-    offs_taken = c.fetchall()
-    
-    off_text = ""
-    for off_start, off_end, off_type_db in offs_taken:
-        off_dt_start = datetime.datetime.strptime(off_start, "%Y-%m-%d").date()
-        off_dt_end = datetime.datetime.strptime(off_end, "%Y-%m-%d").date()
-        if off_dt_end >= today: # Show current/future OFF
-            if off_type_db == "AM":
-                off_type_display = "(AM OFF)"
-            elif off_type_db == "PM":
-                off_type_display = "(PM OFF)"
-            else:
-                off_type_display = "(FULL DAY)"
-                
-            if off_dt_start == off_dt_end:
-                off_text += f"\n🟡 Off Taken: {off_dt_start.strftime('%d %b')} {off_type_display}"
-            else:
-                off_text += f"\n🟡 Off Taken: {off_dt_start.strftime('%d %b')} - {off_dt_end.strftime('%d %b')} {off_type_display}"
-                
-    # --- LEAVEs taken ---
-    c.execute("SELECT start_date, end_date FROM leaves WHERE telegram_id=?", (user_id,))
-    leaves_taken = c.fetchall()
-    
-    leave_text = ""
-    for leave_start, leave_end in leaves_taken:
-        leave_dt_start = datetime.datetime.strptime(leave_start, "%Y-%m-%d").date()
-        leave_dt_end = datetime.datetime.strptime(leave_end, "%Y-%m-%d").date()
-        
-        if leave_dt_end >= today:
-            if leave_dt_start == leave_dt_end:
-                leave_text += f"\n🔵 Leave Taken: {leave_dt_start.strftime('%d %b')}"
-            else:
-                leave_text += f"\n🔵 Leaves Taken: {leave_dt_start.strftime('%d %b')} - {leave_dt_end.strftime('%d %b')}"
-    
-    conn.close()
-    
-    # Daily summary
-    daily_summary = ""
-    if state == "OFF" and start_date and end_date:
-        start_dt = datetime.datetime.strptime(start_date, "%Y-%m-%d").date()
-        end_dt = datetime.datetime.strptime(end_date, "%Y-%m-%d").date()
-        if start_dt <= today <= end_dt:
-            daily_summary = "🟡 You are OFF today."
-    elif state == "LEAVE" and start_date and end_date:
-        start_dt = datetime.datetime.strptime(start_date, "%Y-%m-%d").date()
-        end_dt = datetime.datetime.strptime(end_date, "%Y-%m-%d").date()
-        if start_dt <= today <= end_dt and today.weekday() < 5: # Weekdays only
-            daily_summary = "🔵 You are on LEAVE today."
-    
-    # Full status message
-    text = (
-        f"📌 Status: {status_text}\n"
-        f"🟡 Remaining OFFs: {off_counter}\n"
-        f"🔵 Remaining LEAVEs: {leave_counter}"
-    )
-    if off_text:
-        text += f"{off_text}"
-    if leave_text:
-        text += f"{leave_text}"
-    if daily_summary:
-        text += f"\n{daily_summary}"
-        
-    await update.message.reply_text(text)
+    await update.message.reply_text(get_status_card(user_id))
 
 async def parade(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -753,9 +1349,74 @@ async def strength(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(text)
 
 
+async def strength_summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    today = datetime.date.today().strftime("%Y-%m-%d")
+    text = strength_summary_text(today)
+    
+    if not text:
+        await update.message.reply_text("No users registered.")
+        return
+    
+    await update.message.reply_text(text)
+
+
+def strength_summary_text(today):
+    counts = get_strength_summary(today)
+    if not counts:
+        return None
+    
+    categories = [category for category, _, _ in RANK_CATEGORIES]
+    if any(category == "Others" for category, _ in counts):
+        categories.append("Others")
+    
+    text = f"📈 Bn HQ STRENGTH SUMMARY ({today})\n"
+    for category in categories:
+        row = [counts.get((category, state), 0) for state in AVAILABILITY_STATES]
+        total = sum(row)
+        if not total:
+            continue
+        text += f"\n{category}: {row[0]}/{total} present\n"
+        text += " | ".join(f"{state} {n}" for state, n in zip(AVAILABILITY_STATES, row)) + "\n"
+    
+    grand_total = sum(counts.values())
+    present = sum(n for (_, state), n in counts.items() if state == "PRESENT")
+    text += f"\nTOTAL: {present}/{grand_total} present"
+    
+    return text
+
+
+async def find(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        return
+    
+    text = " ".join(context.args)
+    if not text:
+        await update.message.reply_text("Usage: /find <rank or name>")
+        return
+    
+    rows = find_users(text)
+    if not rows:
+        await update.message.reply_text(f"No personnel matching {text!r}.")
+        return
+    
+    reply = f"🔎 Results for {text!r}\n"
+    for telegram_id, rank, name, off_counter, leave_counter in rows:
+        availability = get_today_status_display(telegram_id)
+        reply += (
+            f"\n{rank} {name} — {availability}\n"
+            f"🟡 OFFs: {off_counter} | 🔵 LEAVEs: {leave_counter}\n"
+        )
+    if len(rows) == FIND_LIMIT:
+        reply += f"\nShowing first {FIND_LIMIT}, refine your search."
+    
+    await update.message.reply_text(reply)
+
+
 async def reset_db(update: Update, context: ContextTypes.DEFAULT_TYPE):
     os.remove(DB_NAME)
     init_db()
+    bump_status_version()
     await update.message.reply_text("🔄 Parade reset.")
 
 
@@ -767,6 +1428,459 @@ async def export_csv(update: Update, context: ContextTypes.DEFAULT_TYPE):
         writer.writerows(users)
     await update.message.reply_document(open("parade.csv", "rb"))
 
+# ====================================
+# BULK OPERATIONS
+# ====================================
+
+def parse_roster_csv(data: str):
+    """
+    Validate a roster CSV (header: telegram_id,rank,name,off_counter,leave_counter).
+    Returns (rows, errors); rows is only usable if errors is empty.
+    """
+    
+    rows = []
+    errors = []
+    seen = set()
+    
+    reader = csv.DictReader(data.splitlines())
+    missing = {"telegram_id", "rank", "name"} - set(reader.fieldnames or [])
+    if missing:
+        return [], [f"Missing columns: {', '.join(sorted(missing))}"]
+    
+    for line_no, row in enumerate(reader, start=2):
+        try:
+            telegram_id = int(row["telegram_id"])
+            offs = float(row.get("off_counter") or 0)
+            leaves = int(row.get("leave_counter") or 0)
+        except (TypeError, ValueError):
+            errors.append(f"Line {line_no}: missing or invalid number")
+            continue
+        
+        if not math.isfinite(offs) or offs < 0 or leaves < 0:
+            errors.append(f"Line {line_no}: balances must be finite and not negative")
+            continue
+        
+        rank = (row["rank"] or "").strip().upper()
+        name = (row["name"] or "").strip().upper()
+        
+        if rank not in RANKS:
+            errors.append(f"Line {line_no}: unknown rank {rank!r}")
+        elif not name:
+            errors.append(f"Line {line_no}: missing name")
+        elif telegram_id in seen:
+            errors.append(f"Line {line_no}: duplicate telegram_id {telegram_id}")
+        else:
+            seen.add(telegram_id)
+            rows.append((telegram_id, rank, name, offs, leaves))
+    
+    return rows, errors
+
+def parse_target_ids(args):
+    # Remaining command args are telegram_ids; none means the whole roster
+    return list(dict.fromkeys(int(arg) for arg in args)) if args else None
+
+def split_absence_targets(conflicts, target_ids, balance_index, amount):
+    """
+    Split users into (ok, skipped) using the rows from get_absence_conflicts().
+    balance_index picks off_counter (0) or leave_counter (1).
+    """
+    
+    if target_ids is None:
+        target_ids = list(conflicts)
+    
+    ok = []
+    skipped = []
+    for user_id in target_ids:
+        row = conflicts.get(user_id)
+        if row is None:
+            skipped.append(f"{user_id}: not registered")
+            continue
+        
+        balance = row[balance_index] or 0
+        leave_clash, off_clash = row[2], row[3]
+        if leave_clash:
+            skipped.append(f"{user_id}: conflict with LEAVE")
+        elif off_clash:
+            skipped.append(f"{user_id}: conflict with OFF")
+        elif amount > balance:
+            skipped.append(f"{user_id}: only {balance} remaining")
+        else:
+            ok.append(user_id)
+    
+    return ok, skipped
+
+def bulk_summary(title, ok, skipped):
+    text = f"{title}\nApplied: {len(ok)}\nSkipped: {len(skipped)}"
+    if skipped:
+        text += "\n\n" + "\n".join(skipped[:50])
+        if len(skipped) > 50:
+            text += f"\n...and {len(skipped) - 50} more"
+    return text
+
+async def import_roster(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        return
+    
+    file = await update.message.document.get_file()
+    data = await file.download_as_bytearray()
+    
+    try:
+        text = bytes(data).decode("utf-8-sig")
+    except UnicodeDecodeError:
+        await update.message.reply_text("❌ CSV must be UTF-8.")
+        return
+    
+    rows, errors = parse_roster_csv(text)
+    if errors:
+        await update.message.reply_text(
+            "❌ Import rejected, nothing saved:\n" + "\n".join(errors[:50])
+        )
+        return
+    if not rows:
+        await update.message.reply_text("❌ CSV has no rows.")
+        return
+    
+    bulk_save_users(rows)
+    await update.message.reply_text(f"✅ Imported {len(rows)} users.")
+
+async def bulk_off(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        return
+    
+    usage = "Usage: /bulkoff YYYY-MM-DD AM|PM|FULL [telegram_id ...]"
+    if len(context.args) < 2:
+        await update.message.reply_text(usage)
+        return
+    
+    date_text = context.args[0]
+    off_type = context.args[1].upper()
+    off_amount = {"AM": 0.5, "PM": 0.5, "FULL": 1.0}.get(off_type)
+    
+    try:
+        off_date = datetime.datetime.strptime(date_text, "%Y-%m-%d").date()
+        target_ids = parse_target_ids(context.args[2:])
+    except ValueError:
+        await update.message.reply_text(usage)
+        return
+    
+    if off_amount is None:
+        await update.message.reply_text(usage)
+        return
+    if off_date < datetime.date.today():
+        await update.message.reply_text("❌ You cannot select a past date.")
+        return
+    
+    conflicts = get_absence_conflicts(date_text, date_text)
+    ok, skipped = split_absence_targets(conflicts, target_ids, 0, off_amount)
+    if ok:
+        bulk_apply_off(ok, date_text, off_type, off_amount)
+    
+    await update.message.reply_text(bulk_summary(f"🟡 Bulk {off_type} OFF on {date_text}", ok, skipped))
+
+async def bulk_leave(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        return
+    
+    usage = "Usage: /bulkleave YYYY-MM-DD YYYY-MM-DD [telegram_id ...]"
+    if len(context.args) < 2:
+        await update.message.reply_text(usage)
+        return
+    
+    start, end = context.args[0], context.args[1]
+    try:
+        start_date = datetime.datetime.strptime(start, "%Y-%m-%d").date()
+        end_date = datetime.datetime.strptime(end, "%Y-%m-%d").date()
+        target_ids = parse_target_ids(context.args[2:])
+    except ValueError:
+        await update.message.reply_text(usage)
+        return
+    
+    if start_date < datetime.date.today():
+        await update.message.reply_text("❌ You cannot select a past date.")
+        return
+    if end_date < start_date:
+        await update.message.reply_text("End date cannot be before start date.")
+        return
+    
+    leave_days = count_leave_days(start_date, end_date)
+    conflicts = get_absence_conflicts(start, end)
+    ok, skipped = split_absence_targets(conflicts, target_ids, 1, leave_days)
+    if ok:
+        bulk_apply_leave(ok, start, end, leave_days)
+    
+    await update.message.reply_text(
+        bulk_summary(f"🔵 Bulk LEAVE {start} to {end} ({leave_days} days)", ok, skipped)
+    )
+
+# ====================================
+# ACCRUAL & RECONCILIATION
+# ====================================
+
+def drift_report():
+    rows = get_balance_drift()
+    if not rows:
+        return "✅ All balances reconcile with history."
+    
+    text = f"⚠️ Balance drift for {len(rows)} users:\n"
+    for rank, name, off_counter, expected_off, leave_counter, expected_leave in rows[:50]:
+        text += f"\n{rank} {name}"
+        if abs(off_counter - expected_off) > 0.001:
+            text += f" | OFFs {off_counter} (expected {expected_off})"
+        if leave_counter != expected_leave:
+            text += f" | LEAVEs {leave_counter} (expected {expected_leave})"
+    if len(rows) > 50:
+        text += f"\n...and {len(rows) - 50} more"
+    return text
+
+async def accrual_job(context: ContextTypes.DEFAULT_TYPE):
+    # Monthly JobQueue job: credit entitlements, then reconcile and report to admins
+    period = datetime.date.today().strftime("%Y-%m")
+    if apply_accruals(period):
+        text = f"➕ Monthly accrual for {period} credited.\n\n" + drift_report()
+    else:
+        text = f"Accrual for {period} was already credited.\n\n" + drift_report()
+    
+    for admin_id in ADMIN_IDS:
+        try:
+            await context.bot.send_message(admin_id, text)
+        except (Forbidden, BadRequest):
+            pass
+
+async def reconcile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        return
+    await update.message.reply_text(drift_report())
+
+# ====================================
+# BROADCAST
+# ====================================
+
+class TokenBucket:
+    """
+    Simple token bucket: refills `rate` tokens per second up to `capacity`.
+    acquire() waits until a token is available.
+    """
+    
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+    
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+    
+    def pause(self, seconds):
+        # Empty the bucket and hold off refilling, so every sender waits out a flood limit
+        self.tokens = 0
+        self.updated = max(self.updated, time.monotonic() + seconds)
+
+# One bucket for every broadcast job, since Telegram's limit is per bot
+BROADCAST_BUCKET = TokenBucket(BROADCAST_RATE, BROADCAST_BATCH)
+
+async def send_with_retry(bot, chat_id, text, bucket):
+    """
+    Send one message through the bucket, retrying on flood control and network errors.
+    Returns True if delivered, False if the user can't be reached.
+    """
+    
+    for attempt in range(BROADCAST_MAX_RETRIES + 1):
+        await bucket.acquire()
+        try:
+            await bot.send_message(chat_id=chat_id, text=text)
+            return True
+        except RetryAfter as e:
+            delay = e.retry_after
+            if isinstance(delay, datetime.timedelta):
+                delay = delay.total_seconds()
+            bucket.pause(delay)
+        except (Forbidden, BadRequest):
+            return False # Blocked the bot or chat not found
+        except NetworkError:
+            await asyncio.sleep(2 ** attempt)
+        except TelegramError:
+            return False # Anything else (e.g. ChatMigrated) counts as a failed send
+    return False
+
+async def broadcast_job(context: ContextTypes.DEFAULT_TYPE):
+    """
+    JobQueue job. job.data holds the admin chat to report to and a list of
+    (chat_id, text) pairs to deliver.
+    """
+    
+    admin_chat_id = context.job.data["admin_chat_id"]
+    messages = context.job.data["messages"]
+    total = len(messages)
+    
+    bucket = BROADCAST_BUCKET
+    try:
+        progress = await context.bot.send_message(admin_chat_id, f"📣 Broadcasting: 0/{total}")
+    except TelegramError:
+        progress = None # Progress is best effort
+    
+    sent = 0
+    failed = 0
+    for i in range(0, total, BROADCAST_BATCH):
+        batch = messages[i:i + BROADCAST_BATCH]
+        results = await asyncio.gather(
+            *(send_with_retry(context.bot, chat_id, text, bucket) for chat_id, text in batch),
+            return_exceptions=True
+        )
+        delivered = sum(1 for result in results if result is True)
+        sent += delivered
+        failed += len(results) - delivered
+        
+        if progress:
+            try:
+                await progress.edit_text(f"📣 Broadcasting: {sent + failed}/{total}")
+            except TelegramError:
+                pass # Progress is best effort
+    
+    await context.bot.send_message(
+        admin_chat_id,
+        f"✅ Broadcast done.\nSent: {sent}\nFailed: {failed}"
+    )
+
+async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        return
+    
+    # Keep the admin's line breaks; context.args would collapse them
+    parts = update.message.text.split(None, 1)
+    text = parts[1].strip() if len(parts) > 1 else ""
+    if not text:
+        await update.message.reply_text("Usage: /broadcast <message>")
+        return
+    
+    messages = [(telegram_id, f"📣 {text}") for telegram_id in get_all_user_ids()]
+    if not messages:
+        await update.message.reply_text("No users registered.")
+        return
+    
+    context.job_queue.run_once(
+        broadcast_job,
+        0,
+        data={"admin_chat_id": update.effective_chat.id, "messages": messages}
+    )
+    await update.message.reply_text(f"📣 Queued broadcast to {len(messages)} users.")
+
+async def remind_leave(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        return
+    
+    tomorrow = (datetime.date.today() + datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+    messages = [
+        (telegram_id, f"🔵 Reminder: your leave starts tomorrow ({start_date} to {end_date}).")
+        for telegram_id, start_date, end_date in get_leaves_starting(tomorrow)
+    ]
+    if not messages:
+        await update.message.reply_text(f"No leaves starting on {tomorrow}.")
+        return
+    
+    context.job_queue.run_once(
+        broadcast_job,
+        0,
+        data={"admin_chat_id": update.effective_chat.id, "messages": messages}
+    )
+    await update.message.reply_text(f"🔵 Queued leave reminders for {len(messages)} users.")
+
+# ====================================
+# INLINE MODE
+# ====================================
+
+def on_leave_text(today):
+    rows = get_on_leave(today)
+    if not rows:
+        return f"🔵 Nobody on LEAVE today ({today})."
+    
+    text = f"🔵 ON LEAVE ({today}): {len(rows)}\n"
+    for rank, name, start_date, end_date in rows:
+        text += f"\n{rank} {name} — {start_date} to {end_date}"
+    return text
+
+def article(result_id, title, text, description=None):
+    return InlineQueryResultArticle(
+        id=result_id,
+        title=title,
+        description=description,
+        input_message_content=InputTextMessageContent(text[:4096]) # Telegram message limit
+    )
+
+def build_inline_results(query, today):
+    results = []
+    
+    if query in ("", "strength"):
+        text = strength_summary_text(today)
+        if text:
+            results.append(article("strength", "📈 Strength summary", text, today))
+    
+    if query in ("", "onleave"):
+        results.append(article("onleave", "🔵 On leave today", on_leave_text(today), today))
+    
+    if query and query not in ("strength", "onleave"):
+        for telegram_id, rank, name, off_counter, leave_counter in find_users(query):
+            availability = get_today_status_display(telegram_id)
+            text = (
+                f"{rank} {name} — {availability}\n"
+                f"🟡 OFFs: {off_counter} | 🔵 LEAVEs: {leave_counter}"
+            )
+            results.append(article(f"user-{telegram_id}", f"{rank} {name}", text, availability))
+    
+    return results
+
+def get_inline_results(query):
+    # Results are cached per query until the date or DATA_VERSION changes
+    global INLINE_CACHE_KEY
+    today = datetime.date.today().strftime("%Y-%m-%d")
+    
+    key = (today, DATA_VERSION)
+    if INLINE_CACHE_KEY != key or len(INLINE_CACHE) >= INLINE_CACHE_MAX:
+        INLINE_CACHE.clear()
+        INLINE_CACHE_KEY = key
+    
+    if query not in INLINE_CACHE:
+        INLINE_CACHE[query] = build_inline_results(query, today)
+    return INLINE_CACHE[query]
+
+def can_view_roster_inline(user_id):
+    return is_admin(user_id) or user_id in INLINE_ROSTER_IDS
+
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    
+    # Only registered personnel can pull parade data into a chat
+    if not get_user(user_id):
+        await update.inline_query.answer([], cache_time=INLINE_CACHE_TIME, is_personal=True)
+        return
+    
+    # Roster-wide data needs the inline allowlist; everyone else gets their own card
+    if can_view_roster_inline(user_id):
+        query = " ".join(update.inline_query.query.lower().split())
+        results = get_inline_results(query)
+    else:
+        results = [article(f"me-{user_id}", "📌 My Status", get_status_card(user_id))]
+    
+    await update.inline_query.answer(
+        results,
+        cache_time=INLINE_CACHE_TIME,
+        is_personal=True
+    )
+
 # ====================================
 # FLASK KEEP-ALIVE SERVER
 # ====================================
@@ -774,15 +1888,133 @@ async def export_csv(update: Update, context: ContextTypes.DEFAULT_TYPE):
 app_flask = Flask(__name__)
 
 bot_app = None
+bot_loop = None # Event loop the bot and JobQueue run on; Flask runs in its own thread
 
 @app_flask.route("/")
 def home():
     return "Bot is alive!", 200
 
+def api_error(status, message):
+    return Response(json.dumps({"error": message}), status=status, mimetype="application/json")
+
+def api_date(name, default=None):
+    value = request.args.get(name, default)
+    datetime.datetime.strptime(value, "%Y-%m-%d") # ValueError/TypeError if missing or invalid
+    return value
+
+def api_response(name, params, build):
+    """
+    Serve build() as JSON with a strong ETag from DATA_VERSION. A matching
+    If-None-Match gets 304 and no DB work; bodies are cached until the next write.
+    """
+    
+    global API_CACHE_KEY
+    
+    auth = request.headers.get("Authorization", "")
+    if not API_TOKEN or not hmac.compare_digest(auth.encode(), f"Bearer {API_TOKEN}".encode()):
+        return api_error(401, "unauthorized")
+    
+    # Each content-coding is a different byte stream, so it gets its own strong ETag
+    use_gzip = request.accept_encodings["gzip"] > 0
+    coding = "gzip" if use_gzip else "identity"
+    
+    version = DATA_VERSION
+    etag = hashlib.sha1(f"{BOOT_ID}:{version}:{name}:{params}:{coding}".encode()).hexdigest()
+    
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        with API_CACHE_LOCK:
+            if API_CACHE_KEY != version or len(API_CACHE) >= API_CACHE_MAX:
+                API_CACHE.clear()
+                API_CACHE_KEY = version
+            
+            cache_key = (name, params)
+            if cache_key not in API_CACHE:
+                body = json.dumps(build()).encode()
+                API_CACHE[cache_key] = (body, gzip.compress(body))
+            body, body_gzip = API_CACHE[cache_key]
+        
+        if use_gzip:
+            response = Response(body_gzip, mimetype="application/json")
+            response.headers["Content-Encoding"] = "gzip"
+        else:
+            response = Response(body, mimetype="application/json")
+    
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["Vary"] = "Accept-Encoding, Authorization"
+    return response
+
+@app_flask.route("/api/strength")
+def api_strength():
+    try:
+        day = api_date("date", datetime.date.today().strftime("%Y-%m-%d"))
+    except (TypeError, ValueError):
+        return api_error(400, "date must be YYYY-MM-DD")
+    
+    # Any date works: get_strength_summary() reads the leaves/offs history, same as /api/absences
+    def build():
+        counts = get_strength_summary(day)
+        categories = {}
+        for (category, state), count in counts.items():
+            categories.setdefault(category, {s: 0 for s in AVAILABILITY_STATES})[state] = count
+        return {
+            "date": day,
+            "categories": categories,
+            "present": sum(n for (_, state), n in counts.items() if state == "PRESENT"),
+            "total": sum(counts.values()),
+        }
+    
+    return api_response("strength", (day,), build)
+
+@app_flask.route("/api/balances")
+def api_balances():
+    def build():
+        return [
+            {
+                "telegram_id": telegram_id,
+                "rank": rank,
+                "name": name,
+                "off_counter": off_counter,
+                "leave_counter": leave_counter,
+            }
+            for telegram_id, rank, name, off_counter, leave_counter in get_balances()
+        ]
+    
+    return api_response("balances", (), build)
+
+@app_flask.route("/api/absences")
+def api_absences():
+    try:
+        start = api_date("start")
+        end = api_date("end", start)
+    except (TypeError, ValueError):
+        return api_error(400, "start (and optional end) must be YYYY-MM-DD")
+    if end < start:
+        return api_error(400, "end cannot be before start")
+    
+    def build():
+        return [
+            {
+                "telegram_id": telegram_id,
+                "rank": rank,
+                "name": name,
+                "type": kind,
+                "start_date": start_date,
+                "end_date": end_date,
+                "off_type": off_type,
+            }
+            for telegram_id, rank, name, kind, start_date, end_date, off_type in get_absences(start, end)
+        ]
+    
+    return api_response("absences", (start, end), build)
+
 @app_flask.route("/webhook", methods=["POST"])
-async def webhook():
+def webhook():
+    # Hand the update to the bot's loop; the Application processes its update_queue
     update = Update.de_json(request.get_json(force=True), bot_app.bot)
-    await bot_app.process_update(update)
+    asyncio.run_coroutine_threadsafe(bot_app.update_queue.put(update), bot_loop)
     return "OK", 200
 
 # ====================================
@@ -790,7 +2022,7 @@ async def webhook():
 # ====================================
 
 async def main():
-    global bot_app
+    global bot_app, bot_loop
     
     init_db()
     
@@ -803,8 +2035,10 @@ async def main():
             ASK_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_name)],
             ASK_OFFS: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_offs)],
             ASK_LEAVES: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_leaves)],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, conversation_timeout)],
         },
-        fallbacks=[]
+        fallbacks=[CommandHandler("cancel", cancel)],
+        conversation_timeout=CONVERSATION_TIMEOUT,
     )
 
     leave_conv = ConversationHandler(
@@ -814,8 +2048,10 @@ async def main():
         states={
             LEAVE_START: [MessageHandler(filters.TEXT & ~filters.COMMAND, leave_start)],
             LEAVE_END: [MessageHandler(filters.TEXT & ~filters.COMMAND, leave_end)],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, conversation_timeout)],
         },
-        fallbacks=[],
+        fallbacks=[CommandHandler("cancel", cancel)],
+        conversation_timeout=CONVERSATION_TIMEOUT,
     )
     
     off_conv = ConversationHandler(
@@ -823,10 +2059,13 @@ async def main():
         states={
             OFF_TYPE: [CallbackQueryHandler(off_type_selected, pattern="^(AM|PM|FULL)$")],
             ASK_OFF_DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, off_date_input)],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, conversation_timeout)],
         },
-        fallbacks=[],
+        fallbacks=[CommandHandler("cancel", cancel)],
+        conversation_timeout=CONVERSATION_TIMEOUT,
     )
     
+    bot_app.add_handler(TypeHandler(Update, touch_user), group=-1)
     bot_app.add_handler(conv)
     bot_app.add_handler(leave_conv)
     bot_app.add_handler(off_conv)
@@ -834,6 +2073,18 @@ async def main():
     bot_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_buttons))
     bot_app.add_handler(CommandHandler("help", help_command))
     bot_app.add_handler(CommandHandler("status", status))
+    bot_app.add_handler(CommandHandler("cancel", cancel))
+    bot_app.add_handler(CommandHandler("broadcast", broadcast))
+    bot_app.add_handler(CommandHandler("remindleave", remind_leave))
+    bot_app.add_handler(CommandHandler("find", find))
+    bot_app.add_handler(CommandHandler("reconcile", reconcile))
+    bot_app.add_handler(CommandHandler("bulkoff", bulk_off))
+    bot_app.add_handler(CommandHandler("bulkleave", bulk_leave))
+    bot_app.add_handler(MessageHandler(filters.Document.FileExtension("csv"), import_roster))
+    bot_app.add_handler(InlineQueryHandler(inline_query))
+    
+    bot_app.job_queue.run_repeating(sweep_user_data, interval=SWEEP_INTERVAL, first=SWEEP_INTERVAL)
+    bot_app.job_queue.run_monthly(accrual_job, when=ACCRUAL_TIME, day=1)
     
     await bot_app.initialize()
     await bot_app.start()
@@ -846,7 +2097,11 @@ async def main():
     print(f"Webhook set to: {webhook_url}")
     
     port = int(os.environ.get("PORT", 10000))
-    app_flask.run(host="0.0.0.0", port=port)
+    bot_loop = asyncio.get_running_loop()
+    Thread(target=app_flask.run, kwargs={"host": "0.0.0.0", "port": port}, daemon=True).start()
+    
+    # Keep the loop free so handlers and JobQueue jobs keep running
+    await asyncio.Event().wait()
     
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file